@@ -2,40 +2,98 @@ import streamlit as st
 import pandas as pd
 import sqlite3
 import hashlib
+import hmac
+import io
+import os
+import re
+import shutil
+import threading
 import plotly.express as px
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import date, datetime
 from pathlib import Path
+from uuid import uuid4
 
 
 # --- 0. PENGATURAN AWAL ---
 UPLOAD_DIR = Path("patient_uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
+# Satu koneksi (st.cache_resource) dipakai bersama oleh semua sesi/thread Streamlit;
+# semua penulisan diserialkan lewat lock ini agar transaksi tidak saling bertumpuk
+DB_WRITE_LOCK = threading.Lock()
+COPY_BUFFER_SIZE = 1024 * 1024 # 1MB per syscall saat menyalin file upload
+SQL_LOGIN = "SELECT password_hash FROM users WHERE username = ?"
+SQL_PATIENT_HEADER = "SELECT id, name, status, handler_user FROM patients WHERE id = ?"
+SQL_PATIENT_FULL = "SELECT * FROM patients WHERE id = ?"
+SCRYPT_PARAMS = dict(n=16384, r=8, p=1, dklen=32)
+SALT_SIZE = 16
+LEGACY_HASH_SIZE = 32 # Digest SHA-256 satu putaran dari versi sebelumnya
+INITIAL_STATUSES = ["Hidup", "Lahir di Sini"] # Status yang boleh diisi saat pasien baru dicatat (form & impor CSV)
 AVAILABLE_TAGS = ["Injeksi", "EKG", "Konsultasi", "Resep Obat", "Tindakan Bedah Minor", "Pemeriksaan Lab"]
+AVAILABLE_TAGS_SET = frozenset(AVAILABLE_TAGS) # Validasi tag O(1) sebelum disimpan
 
 
 # --- 1. PENGATURAN DATABASE ---
 @st.cache_resource
 def get_db_connection():
-    """Membuat dan mengembalikan koneksi ke database SQLite."""
-    conn = sqlite3.connect('patient_dex_final.db', check_same_thread=False)
+    """
+    Membuat dan mengembalikan koneksi ke database SQLite.
+    - WAL + synchronous=NORMAL: pembaca tidak terblokir oleh penulis, fsync lebih jarang
+    - cache 64MB, mmap 256MB, tabel sementara di memori
+    """
+    conn = sqlite3.connect('patient_dex_final.db', check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA foreign_keys=ON")
+    init_db(conn) # Cukup sekali per proses, bukan setiap rerun
     return conn
 
 
+@contextmanager
+def transaction(conn):
+    """
+    Menjalankan beberapa statement dalam satu transaksi (koneksi berjalan dalam mode autocommit).
+    Memegang DB_WRITE_LOCK selama transaksi karena koneksinya dipakai bersama antar thread.
+    """
+    with DB_WRITE_LOCK:
+        conn.execute("BEGIN")
+        try:
+            yield conn
+            conn.execute("COMMIT") # Di dalam try: COMMIT yang gagal (BUSY, FK) ikut di-rollback
+        except BaseException:
+            if conn.in_transaction: # SQLite bisa sudah me-rollback sendiri (FULL/IOERR/BUSY)
+                conn.execute("ROLLBACK")
+            raise
+
+
 def init_db(conn):
     """
     Inisialisasi database dengan skema yang diperbarui.
     - patients: Menambah kolom 'status' (Hidup, Meninggal Dunia, Lahir di Sini) dan 'handler_user'
     - visits: Menambah kolom 'tags' untuk tindakan medis
+    - visit_tags: Tags tindakan per kunjungan (menggantikan JSON di visits.tags)
+    - users: WITHOUT ROWID dengan username sebagai primary key, hash disimpan sebagai BLOB
     """
     cursor = conn.cursor()
+    existing_indexes = {row['name'] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    # Skema users lama (id AUTOINCREMENT + hash hex TEXT) disisihkan dulu untuk dimigrasi
+    if 'id' in [row['name'] for row in cursor.execute("PRAGMA table_info(users)")]:
+        cursor.execute("ALTER TABLE users RENAME TO users_old")
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL
-        )
+            username TEXT PRIMARY KEY,
+            password_hash BLOB NOT NULL
+        ) WITHOUT ROWID
     ''')
+    migrated_users = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_old'").fetchone() is not None
+    if migrated_users:
+        old_users = cursor.execute("SELECT username, password_hash FROM users_old").fetchall()
+        cursor.executemany("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)", [(row['username'], bytes.fromhex(row['password_hash'])) for row in old_users])
+        cursor.execute("DROP TABLE users_old")
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS patients (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -58,11 +116,30 @@ def init_db(conn):
             reason TEXT,
             outcome TEXT,
             progress_status TEXT,
-            tags TEXT, -- Baru: Menyimpan tags sebagai JSON string, misal: '["Injeksi", "EKG"]'
+            tags TEXT, -- Lama: tags sebagai JSON string, kini disimpan di tabel visit_tags
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (patient_id) REFERENCES patients (id) ON DELETE CASCADE
         )
     ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS visit_tags (
+            visit_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (visit_id, tag),
+            FOREIGN KEY (visit_id) REFERENCES visits (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visit_tags_tag ON visit_tags(tag)")
+    # Migrasi data lama: pecah tags JSON dari visits ke visit_tags langsung di SQLite (json_each),
+    # lalu kosongkan visits.tags dalam transaksi yang sama agar migrasi hanya terjadi sekali
+    with transaction(conn):
+        conn.execute('''
+            INSERT OR IGNORE INTO visit_tags (visit_id, tag)
+            SELECT v.id, je.value
+            FROM visits v, json_each(v.tags) je
+            WHERE v.tags IS NOT NULL AND v.tags != '[]'
+        ''')
+        conn.execute("UPDATE visits SET tags = NULL WHERE tags IS NOT NULL")
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS documents (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -73,90 +150,234 @@ def init_db(conn):
             FOREIGN KEY (visit_id) REFERENCES visits (id) ON DELETE CASCADE
         )
     ''')
+    # Indeks untuk laporan bulanan (EXISTS per pasien pada rentang tanggal) dan pencarian nama
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visits_patient_date ON visits(patient_id, visit_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_patients_name ON patients(name)")
+    # Indeks parsial: hanya status kelahiran/kematian yang dihitung di statistik
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_patients_status ON patients(status) WHERE status IN ('Lahir di Sini', 'Meninggal Dunia')")
+    # Indeks full-text (FTS5) untuk pencarian pasien, disinkronkan lewat trigger
+    fts_exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patients_fts'").fetchone() is not None
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(name, diagnosis, notes, content='patients', content_rowid='id')")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_ai AFTER INSERT ON patients BEGIN
+            INSERT INTO patients_fts (rowid, name, diagnosis, notes) VALUES (new.id, new.name, new.diagnosis, new.notes);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_ad AFTER DELETE ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, name, diagnosis, notes) VALUES ('delete', old.id, old.name, old.diagnosis, old.notes);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_au AFTER UPDATE OF name, diagnosis, notes ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, name, diagnosis, notes) VALUES ('delete', old.id, old.name, old.diagnosis, old.notes);
+            INSERT INTO patients_fts (rowid, name, diagnosis, notes) VALUES (new.id, new.name, new.diagnosis, new.notes);
+        END
+    ''')
+    if not fts_exists:
+        cursor.execute("INSERT INTO patients_fts (patients_fts) VALUES ('rebuild')") # Isi indeks dari data pasien yang sudah ada
+    # Statistik query planner hanya untuk indeks yang baru dibuat; bukan ANALYZE penuh di setiap start
+    new_indexes = {row['name'] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")} - existing_indexes
+    for index_name in sorted(new_indexes):
+        cursor.execute(f'ANALYZE "{index_name}"')
     cursor.execute("SELECT * FROM users WHERE username = 'admin'")
     if cursor.fetchone() is None:
         default_password_hash = hash_password('admin123')
         cursor.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", ('admin', default_password_hash))
    
     conn.commit()
+    if migrated_users:
+        cursor.execute("VACUUM") # Sekali saja setelah migrasi untuk mengembalikan halaman kosong
+
+
+# --- 2. FUNGSI AUTENTIKASI ---
+def hash_password(password, salt=None):
+    """Hash password dengan scrypt; disimpan sebagai bytes salt||digest."""
+    salt = salt or os.urandom(SALT_SIZE)
+    return salt + hashlib.scrypt(password.encode(), salt=salt, **SCRYPT_PARAMS)
+
+
+def verify_password(stored_hash, provided_password):
+    """Cocokkan password; digest SHA-256 lama (32 byte) masih diterima."""
+    if len(stored_hash) == LEGACY_HASH_SIZE:
+        return hmac.compare_digest(stored_hash, hashlib.sha256(provided_password.encode()).digest())
+    return hmac.compare_digest(stored_hash, hash_password(provided_password, stored_hash[:SALT_SIZE]))
 
 
-# --- 2. FUNGSI AUTENTIKASI (Tidak Berubah) ---
-def hash_password(password): return hashlib.sha256(password.encode()).hexdigest()
-def verify_password(stored_hash, provided_password): return stored_hash == hash_password(provided_password)
 def login_user(conn, username, password):
-    user = conn.execute("SELECT password_hash FROM users WHERE username = ?", (username,)).fetchone()
-    return user and verify_password(user['password_hash'], password)
+    user = conn.execute(SQL_LOGIN, (username,)).fetchone()
+    if not (user and verify_password(user['password_hash'], password)):
+        return False
+    if len(user['password_hash']) == LEGACY_HASH_SIZE: # Upgrade hash lama ke scrypt setelah login berhasil
+        new_hash = hash_password(password)
+        with DB_WRITE_LOCK:
+            conn.execute("UPDATE users SET password_hash = ? WHERE username = ?", (new_hash, username))
+    return True
 
 
 # --- 3. FUNGSI OPERASI DATABASE (Diperbarui) ---
+def add_patients_bulk(conn, rows):
+    """
+    Menyimpan banyak pasien sekaligus dalam satu transaksi.
+    rows: iterable tuple (name, dob, gender, diagnosis, notes, status, handler_user), dob berformat YYYY-MM-DD.
+    Hanya duplikat (nama + tanggal lahir) yang dilewati; pelanggaran lain (misal NOT NULL) tetap error.
+    Mengembalikan jumlah pasien yang benar-benar ditambahkan.
+    """
+    with transaction(conn):
+        return conn.executemany("INSERT INTO patients (name, dob, gender, diagnosis, notes, status, handler_user) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (name, dob) DO NOTHING", rows).rowcount
+
+
 def add_patient(conn, name, dob, gender, diagnosis, notes, status, handler_user):
-    try:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO patients (name, dob, gender, diagnosis, notes, status, handler_user) VALUES (?, ?, ?, ?, ?, ?, ?)", (name, dob.strftime('%Y-%m-%d'), gender, diagnosis, notes, status, handler_user))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        st.warning(f"Pasien dengan nama '{name}' dan tanggal lahir '{dob.strftime('%Y-%m-%d')}' sudah ada.")
+    dob_str = dob.strftime('%Y-%m-%d')
+    if add_patients_bulk(conn, [(name, dob_str, gender, diagnosis, notes, status, handler_user)]) == 0:
+        st.warning(f"Pasien dengan nama '{name}' dan tanggal lahir '{dob_str}' sudah ada.")
         return False
+    return True
+
+
+def import_patients_csv(conn, csv_file, handler_user):
+    """
+    Impor pasien dari CSV (kolom: name, dob, gender, diagnosis, notes, status; name & dob wajib).
+    Baris tanpa nama, dengan dob bukan YYYY-MM-DD, atau status di luar INITIAL_STATUSES ditolak,
+    bukan dianggap duplikat. Status kosong dianggap 'Hidup'.
+    Mengembalikan (jumlah pasien baru, jumlah duplikat, nomor baris CSV yang ditolak).
+    """
+    df = pd.read_csv(csv_file, dtype=str)
+    df.columns = df.columns.str.strip().str.lower()
+    missing_columns = [column for column in ('name', 'dob') if column not in df.columns]
+    if missing_columns:
+        raise ValueError(f"Kolom wajib tidak ditemukan di CSV: {', '.join(missing_columns)}")
+    df = df.reindex(columns=['name', 'dob', 'gender', 'diagnosis', 'notes', 'status']).astype('string') # Kolom kosong/hilang tetap bertipe string
+    df['name'] = df['name'].str.strip()
+    dob = pd.to_datetime(df['dob'].str.strip(), format='%Y-%m-%d', errors='coerce')
+    df['status'] = df['status'].fillna('Hidup').str.strip()
+    invalid = df['name'].isna() | (df['name'] == '') | dob.isna() | ~df['status'].isin(INITIAL_STATUSES)
+    rejected_rows = (df.index[invalid] + 2).tolist() # Nomor baris di file (baris 1 = header)
+    df = df[~invalid].copy()
+    df['dob'] = dob[~invalid].dt.strftime('%Y-%m-%d') # Seragamkan format agar UNIQUE(name, dob) dan rentang tanggal konsisten
+    df['handler_user'] = handler_user
+    df.loc[df['status'] != 'Lahir di Sini', 'handler_user'] = None
+    df = df.astype(object).where(df.notna(), None) # NaN -> NULL
+    inserted = add_patients_bulk(conn, df.itertuples(index=False, name=None))
+    return inserted, len(df) - inserted, rejected_rows
 
 
 def add_visit(conn, patient_id, visit_date, reason, outcome, progress, tags):
-    import json
-    tags_json = json.dumps(tags) # Simpan list of tags sebagai string JSON
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO visits (patient_id, visit_date, reason, outcome, progress_status, tags) VALUES (?, ?, ?, ?, ?, ?)", (patient_id, visit_date.strftime('%Y-%m-%d'), reason, outcome, progress, tags_json))
-    conn.commit()
-    return cursor.lastrowid
+    unknown_tags = [tag for tag in tags if tag not in AVAILABLE_TAGS_SET]
+    if unknown_tags:
+        st.warning(f"Tag tindakan tidak dikenal: {', '.join(unknown_tags)}")
+        return None
+    with transaction(conn): # Kunjungan + tags di-commit sekali
+        visit_id = conn.execute("INSERT INTO visits (patient_id, visit_date, reason, outcome, progress_status) VALUES (?, ?, ?, ?, ?)", (patient_id, visit_date.strftime('%Y-%m-%d'), reason, outcome, progress)).lastrowid
+        conn.executemany("INSERT INTO visit_tags (visit_id, tag) VALUES (?, ?)", [(visit_id, tag) for tag in tags])
+    return visit_id
+
+
+def safe_filename(file_name):
+    """Nama file aman untuk disimpan di UPLOAD_DIR (tanpa path dan karakter aneh)."""
+    return re.sub(r'[^A-Za-z0-9._-]', '_', Path(file_name).name)
+
+
+def add_documents(conn, visit_id, uploaded_files):
+    """
+    Menyimpan file lampiran kunjungan ke disk lalu mencatatnya dalam satu transaksi.
+    Jika penulisan file atau insert gagal, file yang sudah tertulis dihapus lagi.
+    """
+    written_paths = []
+    rows = []
+    try:
+        for uploaded_file in uploaded_files:
+            # Prefix unik: dua nama yang sama setelah disanitasi tidak saling menimpa
+            file_path = UPLOAD_DIR / f"{visit_id}_{uuid4().hex}_{safe_filename(uploaded_file.name)}"
+            written_paths.append(file_path)
+            with open(file_path, 'wb') as out:
+                shutil.copyfileobj(uploaded_file, out, COPY_BUFFER_SIZE)
+            rows.append((visit_id, uploaded_file.name, str(file_path)))
+        with transaction(conn):
+            conn.executemany("INSERT INTO documents (visit_id, file_name, file_path) VALUES (?, ?, ?)", rows)
+    except BaseException:
+        for file_path in written_paths:
+            file_path.unlink(missing_ok=True)
+        raise
 
 
 def update_patient_status(conn, patient_id, new_status, handler_user):
     """Memperbarui status pasien (misal: menjadi 'Meninggal Dunia')."""
-    cursor = conn.cursor()
-    cursor.execute("UPDATE patients SET status = ?, handler_user = ? WHERE id = ?", (new_status, handler_user, patient_id))
-    conn.commit()
+    with DB_WRITE_LOCK: # Jangan sampai ikut masuk transaksi sesi lain yang bisa di-rollback
+        conn.execute("UPDATE patients SET status = ?, handler_user = ? WHERE id = ?", (new_status, handler_user, patient_id))
+
+
+@st.cache_data(ttl=300, max_entries=64) # Tiap kata kunci unik menyimpan satu DataFrame
+def get_all_patients(_conn, search_term, version):
+    """
+    Mengambil daftar pasien, difilter dengan pencarian full-text (FTS5) pada nama/diagnosis/catatan.
+    Setiap kata dicocokkan sebagai prefix, misal 'bud dem' cocok dengan 'Budi' + 'Demam'.
+    """
+    terms = search_term.split()
+    if not terms:
+        return pd.read_sql_query("SELECT * FROM patients ORDER BY name", _conn)
+    match = " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+    query = """
+        SELECT p.*
+        FROM patients_fts f
+        JOIN patients p ON p.id = f.rowid
+        WHERE patients_fts MATCH ?
+        ORDER BY f.rank
+    """
+    return pd.read_sql_query(query, _conn, params=(match,))
 
 
 # --- 4. FUNGSI UNTUK LAPORAN & STATISTIK ---
-def get_monthly_report(conn, year, month):
+def get_data_version(conn):
+    """
+    Token perubahan data untuk cache laporan.
+    Berubah setiap ada pasien/kunjungan baru; total_changes ikut menangkap update status.
+    """
+    version = conn.execute("SELECT (SELECT COALESCE(MAX(id), 0) FROM visits) || '-' || (SELECT COALESCE(MAX(id), 0) FROM patients)").fetchone()[0]
+    return f"{version}-{conn.total_changes}"
+
+
+@st.cache_data(ttl=300, max_entries=32) # Beberapa pasangan (tahun, bulan) terakhir
+def get_monthly_report(_conn, year, month, version):
     """Mengambil data pasien yang berkunjung pada bulan & tahun tertentu."""
-    start_date = f"{year}-{month:02d}-01"
-    end_date = f"{year}-{month:02d}-31"
+    # Rentang setengah terbuka [awal bulan, awal bulan berikutnya)
+    start_date = date(year, month, 1).isoformat()
+    end_date = date(year + (month == 12), month % 12 + 1, 1).isoformat()
     query = """
-        SELECT DISTINCT p.id, p.name, p.dob, p.gender, p.diagnosis
+        SELECT p.id, p.name, p.dob, p.gender, p.diagnosis
         FROM patients p
-        JOIN visits v ON p.id = v.patient_id
-        WHERE v.visit_date BETWEEN ? AND ?
+        WHERE EXISTS (
+            SELECT 1 FROM visits v
+            WHERE v.patient_id = p.id AND v.visit_date >= ? AND v.visit_date < ?
+        )
     """
-    return pd.read_sql_query(query, conn, params=(start_date, end_date))
+    # Skema hasil sudah pasti: bangun DataFrame langsung tanpa inferensi read_sql_query
+    rows = _conn.execute(query, (start_date, end_date)).fetchall()
+    return pd.DataFrame(rows, columns=['id', 'name', 'dob', 'gender', 'diagnosis'])
 
 
-def get_action_tags_stats(conn):
+@st.cache_data(ttl=300)
+def get_action_tags_stats(_conn, version):
     """Menghitung jumlah setiap tag tindakan dari semua kunjungan."""
-    import json
-    from collections import Counter
-    df = pd.read_sql_query("SELECT tags FROM visits WHERE tags IS NOT NULL AND tags != '[]'", conn)
-    if df.empty:
-        return pd.DataFrame()
-   
-    all_tags = []
-    for tags_json in df['tags']:
-        tags_list = json.loads(tags_json)
-        all_tags.extend(tags_list)
-   
-    tag_counts = Counter(all_tags)
-    return pd.DataFrame(tag_counts.items(), columns=['Tindakan', 'Jumlah']).sort_values('Jumlah', ascending=False)
+    query = """
+        SELECT tag AS Tindakan, COUNT(*) AS Jumlah
+        FROM visit_tags
+        GROUP BY tag
+        ORDER BY Jumlah DESC
+    """
+    return pd.DataFrame(_conn.execute(query).fetchall(), columns=['Tindakan', 'Jumlah'])
 
 
-def get_life_status_stats(conn):
-    """Menghitung statistik kelahiran dan kematian."""
+@st.cache_data(ttl=300)
+def get_life_status_stats(_conn, version):
+    """Menghitung statistik kelahiran dan kematian sebagai dict {status: jumlah}."""
     query = """
-        SELECT status, COUNT(*) as jumlah
+        SELECT status, COUNT(*)
         FROM patients
-        WHERE status = 'Lahir di Sini' OR status = 'Meninggal Dunia'
+        WHERE status IN ('Lahir di Sini', 'Meninggal Dunia')
         GROUP BY status
     """
-    return pd.read_sql_query(query, conn)
+    return {status: jumlah for status, jumlah in _conn.execute(query).fetchall()}
 
 
 # --- 5. ANTARMUKA PENGGUNA (STREAMLIT UI) ---
@@ -199,7 +420,7 @@ def main_app():
             dob = st.date_input("Tanggal Lahir*", min_value=datetime(1920, 1, 1))
             gender = st.selectbox("Jenis Kelamin", ["Laki-laki", "Perempuan", "Lainnya"])
             # Penambahan input status saat menambah pasien baru
-            status = st.selectbox("Status Awal", ["Hidup", "Lahir di Sini"])
+            status = st.selectbox("Status Awal", INITIAL_STATUSES)
             diagnosis = st.text_area("Diagnosis Utama")
             notes = st.text_area("Catatan Tambahan")
             submitted = st.form_submit_button("Simpan Pasien")
@@ -215,6 +436,7 @@ def main_app():
     # --- Halaman Laporan & Statistik (BARU) ---
     elif menu_choice == "Laporan & Statistik":
         st.header("📄 Laporan & Statistik")
+        data_version = get_data_version(conn) # Cache laporan hanya dibuang jika data berubah
 
 
         # 1. Laporan Bulanan
@@ -224,15 +446,16 @@ def main_app():
         report_month = st.selectbox("Pilih Bulan", range(1, 13), format_func=lambda m: datetime(2000, m, 1).strftime('%B'))
        
         if st.button("Buat Laporan"):
-            report_df = get_monthly_report(conn, report_year, report_month)
+            report_df = get_monthly_report(conn, report_year, report_month, data_version)
             if report_df.empty:
                 st.warning(f"Tidak ada kunjungan pasien yang tercatat pada {datetime(2000, report_month, 1).strftime('%B')} {report_year}.")
             else:
                 st.dataframe(report_df, use_container_width=True, hide_index=True)
-                csv_data = report_df.to_csv(index=False).encode('utf-8')
+                csv_buffer = io.BytesIO() # Tulis langsung sebagai bytes, tanpa string CSV perantara
+                report_df.to_csv(csv_buffer, index=False, encoding='utf-8')
                 st.download_button(
                    label="📥 Download Laporan sebagai CSV",
-                   data=csv_data,
+                   data=csv_buffer.getvalue(),
                    file_name=f'laporan_{report_year}-{report_month:02d}.csv',
                    mime='text/csv',
                 )
@@ -244,7 +467,7 @@ def main_app():
         col1, col2 = st.columns(2)
         with col1:
             st.subheader("Statistik Tindakan Medis")
-            stats_df = get_action_tags_stats(conn)
+            stats_df = get_action_tags_stats(conn, data_version)
             if not stats_df.empty:
                 st.dataframe(stats_df, use_container_width=True, hide_index=True)
             else:
@@ -253,10 +476,10 @@ def main_app():
 
         with col2:
             st.subheader("Statistik Kelahiran & Kematian")
-            life_stats_df = get_life_status_stats(conn)
-            if not life_stats_df.empty:
-                for _, row in life_stats_df.iterrows():
-                    st.metric(label=row['status'], value=row['jumlah'])
+            life_stats = get_life_status_stats(conn, data_version)
+            if life_stats:
+                for status, jumlah in life_stats.items():
+                    st.metric(label=status, value=jumlah)
             else:
                 st.info("Belum ada data kelahiran/kematian yang tercatat.")
 
@@ -272,26 +495,33 @@ def main_app():
 def display_patient_details_page(conn): # Ini adalah contoh fungsi yang dipanggil di halaman "Daftar Pasien"
     st.header("📋 Daftar Semua Pasien")
     search_term = st.text_input("Cari berdasarkan nama atau diagnosis:", key="search_box")
-    patients_df = get_all_patients(conn, search_term)
+    # Hasil di-cache per (kata kunci, versi data): rerun tanpa perubahan tidak menyentuh SQLite
+    patients_df = get_all_patients(conn, search_term, get_data_version(conn))
    
     if not patients_df.empty:
-        patient_names = {f"{row['name']} (ID: {row['id']})": row['id'] for _, row in patients_df.iterrows()}
-        selected_patient_key = st.selectbox("Pilih pasien untuk melihat detail:", patient_names.keys())
+        # Selectbox memakai indeks posisi; label dibentuk dari array NumPy tanpa iterrows()
+        names = patients_df['name'].to_numpy()
+        ids = patients_df['id'].to_numpy()
+        selected_index = st.selectbox("Pilih pasien untuk melihat detail:", range(len(ids)), format_func=lambda i: f"{names[i]} (ID: {ids[i]})")
 
 
-        if selected_patient_key:
-            selected_id = patient_names[selected_patient_key]
-            patient = conn.execute("SELECT * FROM patients WHERE id = ?", (selected_id,)).fetchone()
+        if selected_index is not None:
+            selected_id = int(ids[selected_index])
+            patient = conn.execute(SQL_PATIENT_HEADER, (selected_id,)).fetchone()
            
             with st.expander(f"Detail untuk {patient['name']}", expanded=True):
-                # ... (info detail pasien)
+                # Diagnosis & catatan (kolom teks besar) hanya dibaca jika diminta
+                if st.checkbox("Tampilkan diagnosis & catatan", key=f"show_full_{selected_id}"):
+                    patient_full = conn.execute(SQL_PATIENT_FULL, (selected_id,)).fetchone()
+                    st.markdown(f"**Diagnosis:** {patient_full['diagnosis'] or '-'}")
+                    st.markdown(f"**Catatan:** {patient_full['notes'] or '-'}")
                 if patient['status'] == 'Hidup':
                     if st.button("Tandai sebagai 'Meninggal Dunia'", key=f"decease_{selected_id}"):
                         update_patient_status(conn, selected_id, "Meninggal Dunia", st.session_state['username'])
                         st.success("Status pasien telah diperbarui.")
                         st.rerun()
                 else:
-                    st.warning(f"Status Pasien Saat Ini: **{patient['status']}** (Dicatat oleh: {patient.get('handler_user', 'N/A')})")
+                    st.warning(f"Status Pasien Saat Ini: **{patient['status']}** (Dicatat oleh: {patient['handler_user'] or 'N/A'})")
                
                 # ... (tampilkan riwayat kunjungan)
 
@@ -310,15 +540,36 @@ def display_patient_details_page(conn): # Ini adalah contoh fungsi yang dipanggi
                     submit_visit = st.form_submit_button("Simpan Kunjungan")
                     if submit_visit:
                         new_visit_id = add_visit(conn, selected_id, visit_date, reason, outcome, progress, tags)
-                        # ... (logika upload file)
-                        st.success("Riwayat kunjungan berhasil ditambahkan!")
-                        st.rerun()
+                        if new_visit_id is not None:
+                            try:
+                                if uploaded_files:
+                                    add_documents(conn, new_visit_id, uploaded_files)
+                            except (OSError, sqlite3.Error) as e:
+                                st.error(f"Kunjungan tersimpan, tetapi lampiran gagal disimpan: {e}")
+                            else:
+                                st.success("Riwayat kunjungan berhasil ditambahkan!")
+                                st.rerun()
+
+
+def display_import_patients_section(conn):
+    """Impor pasien massal dari CSV; dipanggil di halaman "Tambah Pasien Baru"."""
+    with st.expander("📥 Impor Pasien dari CSV"):
+        st.caption("Kolom: name, dob (YYYY-MM-DD), gender, diagnosis, notes, status")
+        csv_file = st.file_uploader("Pilih file CSV", type="csv", key="import_csv")
+        if csv_file and st.button("Impor Pasien"):
+            try:
+                inserted, duplicates, rejected_rows = import_patients_csv(conn, csv_file, st.session_state['username'])
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                st.success(f"{inserted} pasien baru berhasil diimpor, {duplicates} duplikat dilewati.")
+                if rejected_rows:
+                    st.warning(f"Baris ditolak (nama kosong, dob bukan YYYY-MM-DD, atau status bukan Hidup/Lahir di Sini): {', '.join(map(str, rejected_rows))}")
 
 
 def main():
     st.set_page_config(page_title="D-Patient Dex Pro v2", layout="wide")
-    conn = get_db_connection()
-    init_db(conn)
+    get_db_connection() # init_db dijalankan sekali di dalam koneksi yang di-cache
     if 'logged_in' not in st.session_state: st.session_state['logged_in'] = False
    
     if st.session_state['logged_in']:
@@ -353,6 +604,7 @@ def main_app_integrated():
         # ... (Kode tambah pasien yang sudah diperbarui)
         st.header("➕ Formulir Pasien Baru")
         st.info("Halaman Tambah Pasien. Logika sudah diperbarui di atas.")
+        display_import_patients_section(conn)
     elif menu_choice == "Laporan & Statistik":
         # ... (Kode halaman laporan yang baru)
         st.header("📄 Laporan & Statistik")